@@ -68,6 +68,11 @@ class VectorQuantizer(nn.Module):
 
         return r_R_BChw, idx_R_BL, zqs_post_conv_R_BCHW
 
+    def encode_only(self, f_BCHW: torch.Tensor):
+        # tokenization only needs the indices, skips rebuilding f_hat, the teacher forcing scales and the loss
+        _, idx_R_BL, _ = self.encode(f_BCHW)
+        return idx_R_BL
+
     def decode(self, f_BCHW: torch.Tensor, zqs_post_conv_R_BCHW: torch.Tensor):
         f_hat_BCHW = torch.zeros_like(f_BCHW)
         loss = 0
@@ -2,10 +2,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange
 from torch import Tensor
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from dataclasses import dataclass
+from functools import partial
 
+from .kernels import HAS_TRITON, gn_silu
 from .quant import VectorQuantizer
 
 
@@ -20,48 +22,144 @@ class VQVAEConfig:
     out_ch: int
     vocab_size: int
     patch_sizes: list[int]
-
-
-def swish(x: Tensor) -> Tensor:
-    return x * torch.sigmoid(x)
+    compile: bool = False
+    attn_num_heads: int = 1
+    depthwise_separable_levels: int = 0
+    autocast_dtype: torch.dtype | None = None
+    cuda_graphs: bool = False
+
+
+def fused_gn_silu(x: Tensor, weight: Tensor, bias: Tensor, num_groups: int, eps: float) -> Tensor:
+    # for CUDA inference the hand-written triton kernels do this in one stats reduction + one normalize/affine/silu
+    # pass. They have no backward, so training runs the plain ops, which inductor fuses into the same pair when the
+    # model is built with VQVAEConfig.compile. The plain ops are also what gets traced when compiling / exporting
+    if x.is_cuda and HAS_TRITON and not torch.is_grad_enabled() and not torch.compiler.is_compiling():
+        return gn_silu(x, weight, bias, num_groups, eps)
+    return F.silu(F.group_norm(x, num_groups, weight, bias, eps), inplace=True)
+
+
+class CUDAGraphed(nn.Module):
+    # inference only, opt-in with enable_cuda_graphs(): run_graphed() captures fn into a CUDA graph on first use per
+    # input signature and replays it afterwards. The static buffers stay allocated until the graphs are cleared
+    def __init__(self):
+        super().__init__()
+        self.graphs = None
+
+    def enable_cuda_graphs(self, enabled: bool = True):
+        self.graphs = {} if enabled else None
+
+    def clear_cuda_graphs(self):
+        if self.graphs is not None:
+            self.graphs = {}
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cuda() / .cpu() can reallocate the parameters the graphs read by pointer
+        self.clear_cuda_graphs()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # load_state_dict(assign=True) swaps the parameter tensors
+        self.clear_cuda_graphs()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def train(self, mode: bool = True):
+        self.clear_cuda_graphs()
+        return super().train(mode)
+
+    def __getstate__(self):
+        # CUDA graphs can't be copied or pickled, they are recaptured on demand
+        state = self.__dict__.copy()
+        state["graphs"] = None if self.graphs is None else {}
+        return state
+
+    def run_graphed(self, name: str, fn, h: Tensor) -> Tensor:
+        graphs = self.graphs
+        if graphs is None or not h.is_cuda or torch.is_grad_enabled() or torch.compiler.is_compiling():
+            return fn(h)
+        key = (name, h.shape, h.stride(), h.dtype, h.device, torch.is_autocast_enabled("cuda"), torch.get_autocast_dtype("cuda"), torch.is_inference_mode_enabled())
+        if key not in graphs:
+            static_in = h.clone()
+            # warm up on a side stream so lazy init / compilation happens outside the capture
+            stream = torch.cuda.Stream(h.device)
+            stream.wait_stream(torch.cuda.current_stream(h.device))
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    fn(static_in)
+            torch.cuda.current_stream(h.device).wait_stream(stream)
+            # all levels of a module replay one after another, so their graphs can share one memory pool and reuse
+            # each other's intermediate activations (static outputs stay alive, so they are never handed out again)
+            if "pool" not in graphs:
+                graphs["pool"] = torch.cuda.graph_pool_handle()
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=graphs["pool"]):
+                static_out = fn(static_in)
+            graphs[key] = (graph, static_in, static_out)
+        graph, static_in, static_out = graphs[key]
+        static_in.copy_(h)
+        graph.replay()
+        return static_out.clone()
 
 
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels: int):
+    def __init__(self, in_channels: int, num_heads: int = 1):
         super().__init__()
+        assert in_channels % num_heads == 0, f"in_channels {in_channels} must be divisible by num_heads {num_heads}"
         self.in_channels = in_channels
+        # flash attention needs head_dim <= 256, so split wide bottlenecks into multiple heads
+        self.num_heads = num_heads
+        # restrict SDPA to the IO-aware kernels, math is only allowed when the heads are too wide for them
+        self.sdpa_backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+        if in_channels // num_heads > 256:
+            self.sdpa_backends.append(SDPBackend.MATH)
 
         self.norm = nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
-        self.q = nn.Conv2d(in_channels, in_channels, kernel_size=1)
-        self.k = nn.Conv2d(in_channels, in_channels, kernel_size=1)
-        self.v = nn.Conv2d(in_channels, in_channels, kernel_size=1)
-        self.proj_out = nn.Conv2d(in_channels, in_channels, kernel_size=1)
+        # q, k and v projections fused into a single GEMM
+        self.qkv = nn.Linear(in_channels, 3 * in_channels)
+        self.proj_out = nn.Linear(in_channels, in_channels)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store separate 1x1 conv q/k/v projections and a 1x1 conv proj_out
+        if f"{prefix}q.weight" in state_dict:
+            weight = torch.cat([state_dict.pop(f"{prefix}{name}.weight") for name in "qkv"])
+            bias = torch.cat([state_dict.pop(f"{prefix}{name}.bias") for name in "qkv"])
+            state_dict[f"{prefix}qkv.weight"] = weight.flatten(1)
+            state_dict[f"{prefix}qkv.bias"] = bias
+        if state_dict.get(f"{prefix}proj_out.weight", torch.empty(0)).ndim == 4:
+            state_dict[f"{prefix}proj_out.weight"] = state_dict[f"{prefix}proj_out.weight"].flatten(1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x_BCHW: Tensor) -> Tensor:
         x_BCHW = self.norm(x_BCHW)
-        q_BCHW = self.q(x_BCHW)
-        k_BCHW = self.k(x_BCHW)
-        v_BCHW = self.v(x_BCHW)
 
         B, C, H, W = x_BCHW.shape
-        q_B1HWC = rearrange(q_BCHW, "b c h w -> b 1 (h w) c").contiguous()
-        k_B1HWC = rearrange(k_BCHW, "b c h w -> b 1 (h w) c").contiguous()
-        v_B1HWC = rearrange(v_BCHW, "b c h w -> b 1 (h w) c").contiguous()
-        h_B1HWC = F.scaled_dot_product_attention(q_B1HWC, k_B1HWC, v_B1HWC)
-        h_BCHW = rearrange(h_B1HWC, "b 1 (h w) c -> b c h w", h=H, w=W, c=C, b=B).contiguous()
-        return x_BCHW + self.proj_out(h_BCHW)
+        # plain views, for channels_last inputs x_BHWC is already dense
+        x_BHWC = x_BCHW.flatten(2).transpose(1, 2)
+        qkv_BHW3nd = self.qkv(x_BHWC).view(B, H * W, 3, self.num_heads, -1)
+        q_BnHWd, k_BnHWd, v_BnHWd = qkv_BHW3nd.permute(2, 0, 3, 1, 4).unbind(0)
+        with sdpa_kernel(self.sdpa_backends):
+            h_BnHWd = F.scaled_dot_product_attention(q_BnHWd, k_BnHWd, v_BnHWd)
+        h_BHWC = self.proj_out(h_BnHWd.transpose(1, 2).reshape(B, H * W, C))
+        # back to a channels_last (B, C, H, W) view, no copy
+        return x_BCHW + h_BHWC.transpose(1, 2).reshape(B, C, H, W)
 
 
 class ResnetBlock(nn.Module):
-    def __init__(self, in_channels: int, out_channels: int):
+    def __init__(self, in_channels: int, out_channels: int, depthwise_separable: bool = False):
         super().__init__()
         self.in_channels = in_channels
         out_channels = in_channels if out_channels is None else out_channels
         self.out_channels = out_channels
 
         self.norm1 = nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
-        self.conv1 = nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1)
+        if depthwise_separable:
+            # depthwise 3x3 + pointwise 1x1, ~9x fewer FLOPs than the dense 3x3 for the high res levels
+            self.conv1 = nn.Sequential(
+                nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1, groups=in_channels),
+                nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1, padding=0),
+            )
+        else:
+            self.conv1 = nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1)
         self.norm2 = nn.GroupNorm(num_groups=32, num_channels=out_channels, eps=1e-6, affine=True)
         self.conv2 = nn.Conv2d(out_channels, out_channels, kernel_size=3, stride=1, padding=1)
         if self.in_channels != self.out_channels:
@@ -69,18 +167,17 @@ class ResnetBlock(nn.Module):
 
     def forward(self, x):
         h = x
-        h = self.norm1(h)
-        h = swish(h)
+        h = fused_gn_silu(h, self.norm1.weight, self.norm1.bias, self.norm1.num_groups, self.norm1.eps)
         h = self.conv1(h)
 
-        h = self.norm2(h)
-        h = swish(h)
+        h = fused_gn_silu(h, self.norm2.weight, self.norm2.bias, self.norm2.num_groups, self.norm2.eps)
         h = self.conv2(h)
 
         if self.in_channels != self.out_channels:
             x = self.nin_shortcut(x)
 
-        return x + h
+        # conv backward doesn't need its output, so accumulate the residual into it in place
+        return h.add_(x)
 
 
 class Downsample(nn.Module):
@@ -98,13 +195,54 @@ class Upsample(nn.Module):
     def __init__(self, in_channels: int):
         super().__init__()
         self.conv = nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=1, padding=1)
+        # nearest 2x upsample -> 3x3 conv is exactly a 3x3 conv on the low res input with 4x the output channels
+        # followed by pixel shuffle. For sub-pixel offset x, taps[x, p, a] = 1 if tap a of self.conv reads input pixel p
+        subpixel_taps = torch.tensor([[[1, 0, 0], [0, 1, 1], [0, 0, 0]], [[0, 0, 0], [1, 1, 0], [0, 0, 1]]], dtype=torch.float32)
+        self.register_buffer("subpixel_taps", subpixel_taps, persistent=False)
+        # set by fuse_for_inference
+        self.register_buffer("fused_weight", None, persistent=False)
+        self.register_buffer("fused_bias", None, persistent=False)
+
+    def build_subpixel_weight(self) -> tuple[Tensor, Tensor]:
+        taps = self.subpixel_taps.to(self.conv.weight.dtype)
+        weight_O22I33 = torch.einsum("xpa,yqb,oiab->oxyipq", taps, taps, self.conv.weight)
+        return weight_O22I33.flatten(0, 2), self.conv.bias.repeat_interleave(4)
+
+    def subpixel_weight(self) -> tuple[Tensor, Tensor]:
+        if self.fused_weight is not None:
+            return self.fused_weight, self.fused_bias
+        return self.build_subpixel_weight()
+
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        # always rebuilt from self.conv, written into the existing buffers when re-fusing so their storage stays put
+        weight, bias = self.build_subpixel_weight()
+        if self.fused_weight is None or self.fused_weight.shape != weight.shape or self.fused_weight.dtype != weight.dtype:
+            self.fused_weight, self.fused_bias = weight, bias
+        else:
+            self.fused_weight.copy_(weight)
+            self.fused_bias.copy_(bias)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # self.conv is about to be overwritten, so the cached weights would be stale. Decoder._load_from_state_dict
+        # runs first and clears its CUDA graphs, so no captured graph is left reading the dropped buffers
+        self.fused_weight, self.fused_bias = None, None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def train(self, mode: bool = True):
+        # the cached weights go stale as soon as self.conv is trained again. Decoder.train clears its CUDA graphs
+        # before this runs, so no captured graph is left reading the dropped buffers
+        if mode:
+            self.fused_weight, self.fused_bias = None, None
+        return super().train(mode)
 
     def forward(self, x: Tensor):
-        x = nn.functional.interpolate(x, scale_factor=2.0, mode="nearest")
-        return self.conv(x)
+        # never materializes the 4x larger interpolated tensor
+        weight, bias = self.subpixel_weight()
+        return F.pixel_shuffle(F.conv2d(x, weight, bias, padding=1), 2)
 
 
-class Encoder(nn.Module):
+class Encoder(CUDAGraphed):
     def __init__(
         self,
         resolution: int,
@@ -113,6 +251,8 @@ class Encoder(nn.Module):
         ch_mult: list[int],
         num_res_blocks: int,
         z_channels: int,
+        attn_num_heads: int = 1,
+        depthwise_separable_levels: int = 0,
     ):
         super().__init__()
         self.ch = ch
@@ -133,7 +273,7 @@ class Encoder(nn.Module):
             block_in = ch * in_ch_mult[i_level]
             block_out = ch * ch_mult[i_level]
             for _ in range(self.num_res_blocks):
-                block.append(ResnetBlock(in_channels=block_in, out_channels=block_out))
+                block.append(ResnetBlock(in_channels=block_in, out_channels=block_out, depthwise_separable=i_level < depthwise_separable_levels))
                 block_in = block_out
             down = nn.Module()
             down.block = block
@@ -144,30 +284,40 @@ class Encoder(nn.Module):
             self.down.append(down)
         self.mid = nn.Module()
         self.mid.block_1 = ResnetBlock(in_channels=block_in, out_channels=block_in)
-        self.mid.attn_1 = AttnBlock(block_in)
+        self.mid.attn_1 = AttnBlock(block_in, num_heads=attn_num_heads)
         self.mid.block_2 = ResnetBlock(in_channels=block_in, out_channels=block_in)
         self.norm_out = nn.GroupNorm(num_groups=32, num_channels=block_in, eps=1e-6, affine=True)
         self.conv_out = nn.Conv2d(block_in, z_channels, kernel_size=3, stride=1, padding=1)
 
-    def forward(self, x: Tensor) -> Tensor:
-        h = self.conv_in(x)
-        for i_level in range(self.num_resolutions):
-            for i_block in range(self.num_res_blocks):
-                h = self.down[i_level].block[i_block](h)
-                if len(self.down[i_level].attn) > 0:
-                    h = self.down[i_level].attn[i_block](h)
-            if i_level != self.num_resolutions - 1:
-                h = self.down[i_level].downsample(h)
+    def run_level(self, i_level: int, h: Tensor) -> Tensor:
+        # resolve the level's submodules once instead of on every block
+        down = self.down[i_level]
+        has_attn = len(down.attn) > 0
+        for i_block, block in enumerate(down.block):
+            h = block(h)
+            if has_attn:
+                h = down.attn[i_block](h)
+        if i_level != self.num_resolutions - 1:
+            h = down.downsample(h)
+        return h
+
+    def run_mid(self, h: Tensor) -> Tensor:
         h = self.mid.block_1(h)
         h = self.mid.attn_1(h)
         h = self.mid.block_2(h)
-        h = self.norm_out(h)
-        h = swish(h)
+        return h
+
+    def forward(self, x: Tensor) -> Tensor:
+        h = self.conv_in(x)
+        for i_level in range(self.num_resolutions):
+            h = self.run_graphed(f"down{i_level}", partial(self.run_level, i_level), h)
+        h = self.run_graphed("mid", self.run_mid, h)
+        h = fused_gn_silu(h, self.norm_out.weight, self.norm_out.bias, self.norm_out.num_groups, self.norm_out.eps)
         h = self.conv_out(h)
         return h
 
 
-class Decoder(nn.Module):
+class Decoder(CUDAGraphed):
     def __init__(
         self,
         ch: int,
@@ -177,6 +327,7 @@ class Decoder(nn.Module):
         in_channels: int,
         resolution: int,
         z_channels: int,
+        attn_num_heads: int = 1,
     ):
         super().__init__()
         self.ch = ch
@@ -193,7 +344,7 @@ class Decoder(nn.Module):
 
         self.mid = nn.Module()
         self.mid.block_1 = ResnetBlock(in_channels=block_in, out_channels=block_in)
-        self.mid.attn_1 = AttnBlock(block_in)
+        self.mid.attn_1 = AttnBlock(block_in, num_heads=attn_num_heads)
         self.mid.block_2 = ResnetBlock(in_channels=block_in, out_channels=block_in)
 
         self.up = nn.ModuleList()
@@ -215,21 +366,31 @@ class Decoder(nn.Module):
         self.norm_out = nn.GroupNorm(num_groups=32, num_channels=block_in, eps=1e-6, affine=True)
         self.conv_out = nn.Conv2d(block_in, out_ch, kernel_size=3, stride=1, padding=1)
 
-    def forward(self, z: Tensor) -> Tensor:
-        h = self.conv_in(z)
+    def run_level(self, i_level: int, h: Tensor) -> Tensor:
+        # resolve the level's submodules once instead of on every block
+        up = self.up[i_level]
+        has_attn = len(up.attn) > 0
+        for i_block, block in enumerate(up.block):
+            h = block(h)
+            if has_attn:
+                h = up.attn[i_block](h)
+        if i_level != 0:
+            h = up.upsample(h)
+        return h
+
+    def run_mid(self, h: Tensor) -> Tensor:
         h = self.mid.block_1(h)
         h = self.mid.attn_1(h)
         h = self.mid.block_2(h)
+        return h
+
+    def forward(self, z: Tensor) -> Tensor:
+        h = self.conv_in(z)
+        h = self.run_graphed("mid", self.run_mid, h)
         for i_level in reversed(range(self.num_resolutions)):
-            for i_block in range(self.num_res_blocks + 1):
-                h = self.up[i_level].block[i_block](h)
-                if len(self.up[i_level].attn) > 0:
-                    h = self.up[i_level].attn[i_block](h)
-            if i_level != 0:
-                h = self.up[i_level].upsample(h)
+            h = self.run_graphed(f"up{i_level}", partial(self.run_level, i_level), h)
 
-        h = self.norm_out(h)
-        h = swish(h)
+        h = fused_gn_silu(h, self.norm_out.weight, self.norm_out.bias, self.norm_out.num_groups, self.norm_out.eps)
         h = self.conv_out(h)
         return h
 
@@ -238,7 +399,16 @@ class VQVAE(nn.Module):
     def __init__(self, config: VQVAEConfig):
         super().__init__()
         self.config = config
-        self.encoder = Encoder(resolution=config.resolution, in_channels=config.in_channels, ch=config.dim, ch_mult=config.ch_mult, num_res_blocks=config.num_res_blocks, z_channels=config.z_channels)
+        self.encoder = Encoder(
+            resolution=config.resolution,
+            in_channels=config.in_channels,
+            ch=config.dim,
+            ch_mult=config.ch_mult,
+            num_res_blocks=config.num_res_blocks,
+            z_channels=config.z_channels,
+            attn_num_heads=config.attn_num_heads,
+            depthwise_separable_levels=config.depthwise_separable_levels,
+        )
         self.decoder = Decoder(
             ch=config.dim,
             out_ch=config.out_ch,
@@ -247,15 +417,121 @@ class VQVAE(nn.Module):
             in_channels=config.in_channels,
             resolution=config.resolution,
             z_channels=config.z_channels,
+            attn_num_heads=config.attn_num_heads,
         )
         self.quantizer = VectorQuantizer(vocab_size=config.vocab_size, dim=config.z_channels, patch_sizes=config.patch_sizes)
+        # NHWC lets cuDNN pick its faster (tensor core) conv kernels
+        self.encoder.to(memory_format=torch.channels_last)
+        self.decoder.to(memory_format=torch.channels_last)
+        if config.compile:
+            # in-place compile keeps the state_dict keys free of the `_orig_mod.` prefix
+            # the quantizer stays eager since its argmin / codebook lookups are data dependent
+            self.encoder.compile(mode="reduce-overhead", fullgraph=False)
+            self.decoder.compile(mode="reduce-overhead", fullgraph=False)
+        if config.cuda_graphs:
+            self.encoder.enable_cuda_graphs()
+            self.decoder.enable_cuda_graphs()
+        self.aot = {}  # name -> ((shape, dtype, device) of the input, AOT Inductor runner), see compile_aot
+        self.streams = None  # (encoder, decoder) CUDA streams, created lazily by forward_pipelined
+
+    def autocast(self, x: Tensor):
+        # opt-in via config.autocast_dtype, bf16 has fp32's exponent range so no loss scaling is needed and autocast
+        # keeps GroupNorm stats in fp32. Pre-Ampere GPUs only emulate bf16, so there it stays off.
+        # The weight cast cache is off since cached casts would be freed under captured CUDA graphs
+        dtype = self.config.autocast_dtype
+        enabled = x.is_cuda and dtype is not None
+        if enabled and dtype == torch.bfloat16:
+            enabled = torch.cuda.is_bf16_supported(including_emulation=False)
+        return torch.autocast("cuda", dtype=dtype, enabled=enabled, cache_enabled=False)
+
+    def run(self, name: str, x: Tensor) -> Tensor:
+        # runs the encoder / decoder, the output is cast back from the autocast dtype to x's dtype so the
+        # quantizer sees full precision in an fp32 model and a half precision model stays in its own dtype
+        x = x.contiguous(memory_format=torch.channels_last)
+        if name in self.aot and not torch.is_grad_enabled():
+            signature, runner = self.aot[name]
+            if (x.shape, x.dtype, x.device) == signature:
+                return runner(x).to(x.dtype)
+        with self.autocast(x):
+            return getattr(self, name)(x).to(x.dtype)
 
     def forward(self, x):
-        f = self.encoder(x)
+        f = self.run("encoder", x)
         fhat, r_maps, idxs, scales, loss = self.quantizer(f)
-        x_hat = self.decoder(fhat)
+        x_hat = self.run("decoder", fhat)
         return x_hat, r_maps, idxs, scales, loss
 
+    def forward_pipelined(self, x_chunks: list[Tensor]) -> list[tuple]:
+        # same as [self(x) for x in x_chunks] but the encoder + quantizer of chunk i run on their own CUDA stream
+        # and overlap with the decoder of chunk i - 1
+        if not x_chunks or not x_chunks[0].is_cuda:
+            return [self(x) for x in x_chunks]
+        if self.streams is None:
+            self.streams = (torch.cuda.Stream(x_chunks[0].device), torch.cuda.Stream(x_chunks[0].device))
+        enc_stream, dec_stream = self.streams
+        main_stream = torch.cuda.current_stream(x_chunks[0].device)
+        enc_stream.wait_stream(main_stream)
+        dec_stream.wait_stream(main_stream)
+        outputs = []
+        for x in x_chunks:
+            with torch.cuda.stream(enc_stream):
+                f = self.run("encoder", x)
+                fhat, r_maps, idxs, scales, loss = self.quantizer(f)
+            dec_stream.wait_stream(enc_stream)
+            # fhat was allocated on enc_stream, keep the allocator from handing it back out while the decoder reads it
+            fhat.record_stream(dec_stream)
+            with torch.cuda.stream(dec_stream):
+                x_hat = self.run("decoder", fhat)
+            outputs.append((x_hat, r_maps, idxs, scales, loss))
+        main_stream.wait_stream(enc_stream)
+        main_stream.wait_stream(dec_stream)
+        return outputs
+
+    @torch.no_grad()
+    def compile_aot(self, batch_size: int, resolution: int | None = None):
+        # specializes encoder and decoder for one input shape with AOT Inductor, used by run() when grads are off.
+        # Weights are baked into the packages (load_state_dict() and model.train() drop them) and the graphs
+        # are exported under the same autocast as the eager path. The quantizer stays eager since its argmin /
+        # codebook lookups are data dependent
+        resolution = resolution or self.config.resolution
+        param = next(self.parameters())
+        z_resolution = resolution // self.decoder.ffactor
+        examples = {
+            "encoder": torch.randn(batch_size, self.config.in_channels, resolution, resolution, device=param.device, dtype=param.dtype),
+            "decoder": torch.randn(batch_size, self.config.z_channels, z_resolution, z_resolution, device=param.device, dtype=param.dtype),
+        }
+        for name, example in examples.items():
+            example = example.contiguous(memory_format=torch.channels_last)
+            with self.autocast(example):
+                exported = torch.export.export(getattr(self, name), (example,))
+                path = torch._inductor.aoti_compile_and_package(exported)
+            self.aot[name] = ((example.shape, example.dtype, example.device), torch._inductor.aoti_load_package(path))
+        return self
+
+    def train(self, mode: bool = True):
+        # the AOT packages have the weights baked in, they go stale as soon as the model is trained again
+        if mode:
+            self.aot = {}
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # same for newly loaded weights
+        self.aot = {}
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def fuse_for_inference(self):
+        # GroupNorm's affine can't be folded into the next conv because of the SiLU in between (fused_gn_silu
+        # already applies it in the same pass), so the foldable work left is the Upsample sub-pixel weights.
+        # load_state_dict() and model.train() undo it.
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, Upsample):
+                module.fuse_for_inference()
+        # captured graphs may have been recorded against the unfused weights
+        self.encoder.clear_cuda_graphs()
+        self.decoder.clear_cuda_graphs()
+        return self
+
     def get_nearest_embedding(self, idxs):
         return self.quantizer.codebook(idxs)
 
@@ -263,12 +539,12 @@ class VQVAE(nn.Module):
         return self.quantizer.get_next_autoregressive_input(idx, f_hat_BCHW, h_BChw)
 
     def to_img(self, f_hat_BCHW):
-        return self.decoder(f_hat_BCHW).clamp(-1, 1)
+        return self.run("decoder", f_hat_BCHW).clamp(-1, 1)
 
+    @torch.no_grad()
     def img_to_indices(self, x):
-        f = self.encoder(x)
-        fhat, r_maps, idxs, scales, loss = self.quantizer(f)
-        return idxs
+        # no_grad rather than inference_mode, the indices feed embedding lookups that get saved for backward
+        return self.quantizer.encode_only(self.run("encoder", x))
 
 
 if __name__ == "__main__":
@@ -298,3 +574,44 @@ if __name__ == "__main__":
         assert param.grad is not None
     print("Success")
     print("Number of parameters:", sum(p.numel() for p in model.parameters()) / 1e6, "M")
+
+    with torch.no_grad():
+        # the sub-pixel Upsample must match nearest interpolation followed by the 3x3 conv exactly
+        upsample = Upsample(64)
+        x = torch.randn((2, 64, 7, 9))
+        expected = upsample.conv(F.interpolate(x, scale_factor=2.0, mode="nearest"))
+        for memory_format in (torch.contiguous_format, torch.channels_last):
+            out = upsample(x.contiguous(memory_format=memory_format))
+            assert torch.allclose(out, expected, atol=1e-5, rtol=1e-5), f"Upsample mismatch for {memory_format}"
+    print("Upsample matches interpolate + conv")
+
+    with torch.no_grad():
+        # a baseline format AttnBlock state_dict (separate 1x1 conv q / k / v and a 1x1 conv proj_out) must load and
+        # give the same output
+        C = 64
+        old_sd = {"norm.weight": torch.randn(C), "norm.bias": torch.randn(C)}
+        for name in "qkv":
+            old_sd[f"{name}.weight"] = torch.randn((C, C, 1, 1)) * C**-0.5
+            old_sd[f"{name}.bias"] = torch.randn(C)
+        old_sd["proj_out.weight"] = torch.randn((C, C, 1, 1)) * C**-0.5
+        old_sd["proj_out.bias"] = torch.randn(C)
+        attn = AttnBlock(C)
+        attn.load_state_dict(old_sd)
+
+        x = torch.randn((2, C, 5, 6))
+        h = F.group_norm(x, 32, old_sd["norm.weight"], old_sd["norm.bias"], 1e-6)
+        q, k, v = (F.conv2d(h, old_sd[f"{name}.weight"], old_sd[f"{name}.bias"]).flatten(2).transpose(1, 2) for name in "qkv")
+        h_BCHW = F.scaled_dot_product_attention(q, k, v).transpose(1, 2).reshape(x.shape)
+        expected = h + F.conv2d(h_BCHW, old_sd["proj_out.weight"], old_sd["proj_out.bias"])
+        assert torch.allclose(attn(x), expected, atol=1e-5, rtol=1e-5), "AttnBlock mismatch after loading a baseline state_dict"
+    print("AttnBlock loads baseline checkpoints")
+
+    if torch.cuda.is_available() and HAS_TRITON:
+        # 23 * 23 is not a multiple of the kernels' L tile, so the masked tail is exercised too
+        x = torch.randn((2, 512, 23, 23), device="cuda")
+        weight, bias = torch.randn(512, device="cuda"), torch.randn(512, device="cuda")
+        expected = F.silu(F.group_norm(x, 32, weight, bias, 1e-6))
+        for memory_format in (torch.contiguous_format, torch.channels_last):
+            out = gn_silu(x.contiguous(memory_format=memory_format), weight, bias, 32, 1e-6)
+            assert torch.allclose(out, expected, atol=1e-4, rtol=1e-4), f"gn_silu mismatch for {memory_format}"
+        print("gn_silu matches F.silu(F.group_norm(...))")